@@ -10,10 +10,14 @@
 # datetime.fromisoformat() implementation. If we have to run on 3.10 or below,
 # we could add the dateutil package as a dependency.
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 import csv
+import io
 import json
+import operator
 import os
 import os.path
 import sys
@@ -27,6 +31,20 @@ if sys.version_info.major == 3 and sys.version_info.minor <= 10:
 
 utc_date_header = "Date (UTC)"
 
+# ETag of the last GitHub releases response we processed
+github_etag_path = "github_release/.etag"
+
+# Release info fields copied as-is from the GitHub API
+auto_release_columns = {
+    "id",
+    "tag_name",
+    "name",
+    "draft",
+    "prerelease",
+    "created_at",
+    "published_at",
+}
+
 
 # Extract the current UTC time, and store in a sort-of ISO format. Don't use
 # the official YYYY-MM-DDTHH:MM:SS format or add timezone info, because those
@@ -36,9 +54,121 @@ def now_time_string():
     return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def query_github_releases():
-    now_time = now_time_string()
+# Convert a timestamp from the GitHub API to the same format as
+# now_time_string(). GitHub returns UTC times like "2024-01-02T03:04:05Z",
+# which we can just slice into shape. Anything else goes through a full parse.
+def github_time_string(iso_time):
+    if len(iso_time) == 20 and iso_time.endswith("Z"):
+        return f"{iso_time[:10]} {iso_time[11:19]}"
+    return (
+        datetime.fromisoformat(iso_time)
+        .astimezone(timezone.utc)
+        .strftime("%Y-%m-%d %H:%M:%S")
+    )
+
+
+# Gather the info of a single release, and append its current download counts
+# to the release's CSV file. existing_csvs is the set of file names already in
+# the downloads folder. Returns the release info row, and the download
+# count row (None if the release has no assets).
+def _process_release(release, now_time, existing_csvs):
+    # Gather release info, and fix up date time to be spreadsheet parsable
+    release_row = {c: release[c] for c in auto_release_columns}
+    for field in ["created_at", "published_at"]:
+        release_row[field] = github_time_string(release_row[field])
+    release_row["author"] = release["author"]["login"]
+    release_row["num_assets"] = len(release["assets"])
+
+    # Add a row of download counts for each asset to the CSV. Make the CSV file
+    # if it doesn't exist. If one is already there, parses it to make sure the
+    # header matches the assets we have. The logic here is slightly complicated
+    # just to make sure if we added/removed assets from this release, the
+    # column order will still make sense.
+
+    release_csv_path = os.path.join(
+        "github_release/downloads", f'{release["tag_name"]}.csv'
+    )
+    release_json_path = os.path.join(
+        "github_release/info", f'{release["tag_name"]}.json'
+    )
+    new_release_csv = f'{release["tag_name"]}.csv' not in existing_csvs
+
+    asset_names = [asset["name"] for asset in release["assets"]]
+    if len(asset_names) == 0:
+        return release_row, None
+
+    row = {asset["name"]: asset["download_count"] for asset in release["assets"]}
+
+    if new_release_csv:
+        # A new release. Write the header and the first row in one go.
+        with open(release_csv_path, "w", newline="") as release_csv_file:
+            writer = csv.writer(release_csv_file)
+            writer.writerow([utc_date_header] + asset_names)
+            writer.writerow([now_time] + [row[name] for name in asset_names])
+    else:
+        # Open the file only once, both to check the header and to write to it.
+        with open(
+            release_csv_path, "r+", newline="", buffering=65536
+        ) as release_csv_file:
+            reader = csv.reader(release_csv_file)
+            header = next(reader, None)
+            if header == None:
+                print(f"Found csv file with no headers: {release_csv_path}")
+                exit(-1)
+
+            old_asset_names = header[1:]
+            old_asset_names_set = set(old_asset_names)
+
+            new_asset_names = [n for n in asset_names if n not in old_asset_names_set]
+            asset_names = old_asset_names + new_asset_names
+
+            writer = csv.writer(release_csv_file)
+
+            if len(new_asset_names) > 0:
+                # We have added new assets to this release. We need to convert
+                # the CSV file because we need to change the header, which also
+                # means we need to read the rest of the file so we can write
+                # them back. New assets are always added as new columns at the
+                # end, so the old rows just need to be padded with empty cells.
+                print(
+                    f'Release {release["tag_name"]} added assets f{new_asset_names}. Converting CSV file.'
+                )
+                # Build the converted file in memory, then write it out in one go.
+                num_columns = len(asset_names) + 1
+                converted_csv = io.StringIO()
+                converted_writer = csv.writer(converted_csv)
+                converted_writer.writerow([utc_date_header] + asset_names)
+                converted_writer.writerows(
+                    existing_row + [""] * (num_columns - len(existing_row))
+                    for existing_row in reader
+                )
+
+                release_csv_file.seek(0)
+                release_csv_file.truncate()
+                release_csv_file.write(converted_csv.getvalue())
+            else:
+                # Otherwise, we only need to append to the end of the file.
+                release_csv_file.seek(0, os.SEEK_END)
+
+            writer.writerow([now_time] + [row.get(name, "") for name in asset_names])
+
+    # Also write out the release's JSON just for reference instead of needing query GitHub in the future.
+    # Older releases rarely change, so only write the file if the content is different.
+    release_json = json.dumps(release, indent=2)
+    try:
+        with open(release_json_path, "r") as release_json_file:
+            release_json_changed = release_json_file.read() != release_json
+    except FileNotFoundError:
+        release_json_changed = True
+
+    if release_json_changed:
+        with open(release_json_path, "w") as release_json_file:
+            release_json_file.write(release_json)
 
+    return release_row, row
+
+
+def fetch_github_releases():
     # Using GitHub Token is optional as releases is public. Using a token helps prevent rate limiting.
     gh_token = os.environ.get("GITHUB_TOKEN")
 
@@ -47,23 +177,34 @@ def query_github_releases():
     if gh_token != None:
         request.add_header("Authorization", f"Bearer {gh_token}")
     request.add_header("User-Agent", "macvim-download-stats")
-    response = urlopen(request)
 
-    releases = json.loads(response.read())
+    # Send the ETag of the last response we processed. If nothing has changed
+    # since then, GitHub replies with 304 Not Modified (which doesn't count
+    # against the rate limit) and we don't need to download the releases.
+    try:
+        with open(github_etag_path, "r") as etag_file:
+            request.add_header("If-None-Match", etag_file.read().strip())
+    except FileNotFoundError:
+        pass
 
-    first_item = True
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 304:
+            return None, None
+        raise
+
+    return json.load(response), response.headers.get("ETag")
+
+
+# releases and etag are None if GitHub reported no changes since the last run.
+def query_github_releases(releases, etag):
+    if releases == None:
+        print("  Releases have not changed since the last query. Skipping.")
+        return
+
+    now_time = now_time_string()
 
-    # Release info to gather in a separate table
-    new_release_rows = []
-    auto_release_columns = {
-        "id",
-        "tag_name",
-        "name",
-        "draft",
-        "prerelease",
-        "created_at",
-        "published_at",
-    }
     release_columns = [
         "id",
         "tag_name",
@@ -76,136 +217,68 @@ def query_github_releases():
         "published_at",
     ]
 
-    # Loop through all releases
-    for release in releases:
-        # Gather release info, and fix up date time to be spreadsheet parsable
-        release_row = {c: release[c] for c in auto_release_columns}
-        for field in ["created_at", "published_at"]:
-            release_row[field] = (
-                datetime.fromisoformat(release_row[field])
-                .astimezone(timezone.utc)
-                .strftime("%Y-%m-%d %H:%M:%S")
+    # Make the output folders once, and list the existing CSV files up front,
+    # so we don't need to stat the file system for each release.
+    os.makedirs("github_release/downloads", exist_ok=True)
+    os.makedirs("github_release/info", exist_ok=True)
+    existing_csvs = {entry.name for entry in os.scandir("github_release/downloads")}
+
+    # Process all releases. Each release only touches its own files, and the
+    # work is dominated by file I/O, so spread it over a thread pool.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda release: _process_release(release, now_time, existing_csvs),
+                releases,
             )
-        release_row["author"] = release["author"]["login"]
-        release_row["num_assets"] = len(release["assets"])
-        new_release_rows.append(release_row)
-
-        # Add a row of download counts for each asset to the CSV. Make the CSV file
-        # if it doesn't exist. If one is already there, parses it to make sure the
-        # header matches the assets we have. The logic here is slightly complicated
-        # just to make sure if we added/removed assets from this release, the
-        # column order will still make sense.
-
-        release_csv_path = os.path.join(
-            "github_release/downloads", f'{release["tag_name"]}.csv'
-        )
-        release_json_path = os.path.join(
-            "github_release/info", f'{release["tag_name"]}.json'
         )
-        new_release_csv = not os.path.exists(release_csv_path)
-
-        asset_names = [asset["name"] for asset in release["assets"]]
-        if len(asset_names) == 0:
-            continue
-
-        existing_rows = []  # Only used when need to convert CSV file
-
-        if new_release_csv:
-            os.makedirs(os.path.dirname(release_csv_path), exist_ok=True)
-            with open(release_csv_path, "w", newline="") as release_csv_file:
-                writer = csv.writer(release_csv_file)
-                writer.writerow([utc_date_header] + asset_names)
-        else:
-            with open(release_csv_path, "r", newline="") as release_csv_file:
-                reader = csv.DictReader(release_csv_file)
-                header = reader.fieldnames
-                if reader.fieldnames == None:
-                    print(f"Found csv file with no headers: {release_csv_path}")
-                    exit(-1)
-
-                old_asset_names = reader.fieldnames[1:]
-                old_asset_names_set = set(old_asset_names)
-
-                new_asset_names = [
-                    n for n in asset_names if n not in old_asset_names_set
-                ]
-                asset_names = old_asset_names + [
-                    n for n in asset_names if n not in old_asset_names_set
-                ]
 
-                if len(new_asset_names) > 0:
-                    # We have added new assets to this release. We need to convert
-                    # the CSV file because we need to change the header, which also
-                    # means we need to read the rest of the file so we can write
-                    # them back later.
-                    print(
-                        f'Release {release["tag_name"]} added assets f{new_asset_names}. Converting CSV file.'
-                    )
-                    existing_rows = [row for row in reader]
-
-        # We only append to the end of the file unless we have added assets forcing
-        # us to re-write the header.
-        file_mode = "w" if len(existing_rows) > 0 else "a"
-
-        with open(release_csv_path, file_mode, newline="") as release_csv_file:
-            writer = csv.DictWriter(
-                release_csv_file, fieldnames=[utc_date_header] + asset_names
-            )
-
-            if len(existing_rows) > 0:
-                writer.writeheader()
-                writer.writerows(existing_rows)
-
-            row = {
-                name: download_count
-                for (name, download_count) in [
-                    (asset["name"], asset["download_count"])
-                    for asset in release["assets"]
-                ]
-            }
-
-            if first_item:
-                print("  " + str(row))
-
-            row[utc_date_header] = now_time
-            writer.writerow(row)
-
-        # Also write out the release's JSON just for reference instead of needing query GitHub in the future
-        os.makedirs(os.path.dirname(release_json_path), exist_ok=True)
-        with open(release_json_path, "w") as release_json_file:
-            json.dump(release, release_json_file, indent=2)
+    new_release_rows = [release_row for (release_row, _) in results]
 
-        first_item = False
+    download_rows = [row for (_, row) in results if row != None]
+    if len(download_rows) > 0:
+        print("  " + str(download_rows[0]))
 
     # Output the releases info into its own table so we can look up metadata like publish date etc
+    # Only releases we haven't seen before need to be added. Release IDs
+    # increase over time, so appending the new ones in order keeps the table
+    # sorted by ID without rewriting it.
     releases_info_csv_path = "github_release/releases.csv"
-    if os.path.exists(releases_info_csv_path):
+    try:
         with open(releases_info_csv_path, "r", newline="") as releases_info_file:
-            reader = csv.DictReader(releases_info_file)
-            old_release_rows = [row for row in reader]
-
-        old_release_ids = {release["id"] for release in old_release_rows}
-
-        release_rows = old_release_rows
-        release_rows += [
-            r for r in new_release_rows if str(r["id"]) not in old_release_ids
-        ]
-    else:
+            reader = csv.reader(releases_info_file)
+            id_column = next(reader).index("id")
+            old_release_ids = {int(row[id_column]) for row in reader}
+    except FileNotFoundError:
         release_rows = new_release_rows
+        file_mode = "w"
+    else:
+        release_rows = [r for r in new_release_rows if r["id"] not in old_release_ids]
+        file_mode = "a"
 
-    release_rows = sorted(release_rows, key=lambda o: int(o["id"]))
+    release_rows.sort(key=operator.itemgetter("id"))
 
-    with open(releases_info_csv_path, "w", newline="") as releases_info_file:
-        writer = csv.DictWriter(releases_info_file, fieldnames=release_columns)
-        writer.writeheader()
-        writer.writerows(release_rows)
+    if file_mode == "w" or len(release_rows) > 0:
+        with open(releases_info_csv_path, file_mode, newline="") as releases_info_file:
+            writer = csv.DictWriter(releases_info_file, fieldnames=release_columns)
+            if file_mode == "w":
+                writer.writeheader()
+            writer.writerows(release_rows)
 
+    # Only save the ETag after everything has been written out, so a failed
+    # run doesn't cause the next one to skip.
+    if etag != None:
+        with open(github_etag_path, "w") as etag_file:
+            etag_file.write(etag)
 
-def query_homebrew_installs():
-    now_time = now_time_string()
 
+def fetch_homebrew_formula():
     response = urlopen("https://formulae.brew.sh/api/formula/macvim.json")
-    formula_info = json.loads(response.read())
+    return json.load(response)
+
+
+def query_homebrew_installs(formula_info):
+    now_time = now_time_string()
 
     generated_date = formula_info["generated_date"]
     version = formula_info["versions"]["stable"]
@@ -216,10 +289,19 @@ def query_homebrew_installs():
 
     csv_path = os.path.join("homebrew", "installs.csv")
 
-    if not os.path.exists(csv_path):
-        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
-        with open(csv_path, "w", newline="") as csv_file:
-            writer = csv.writer(csv_file)
+    # Create the file if it doesn't exist yet, in which case it needs a header.
+    # Otherwise just append to it.
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    try:
+        csv_file = open(csv_path, "x", newline="")
+        new_csv = True
+    except FileExistsError:
+        csv_file = open(csv_path, "a", newline="")
+        new_csv = False
+
+    with csv_file:
+        writer = csv.writer(csv_file)
+        if new_csv:
             writer.writerow(
                 [
                     utc_date_header,
@@ -229,9 +311,6 @@ def query_homebrew_installs():
                     "install_on_request.30d",
                 ]
             )
-
-    with open(csv_path, "a", newline="") as csv_file:
-        writer = csv.writer(csv_file)
         writer.writerow(
             [now_time, generated_date, version, num_installs, num_installs_on_request]
         )
@@ -242,8 +321,14 @@ def query_homebrew_installs():
 
 
 if __name__ == "__main__":
-    print("Querying GitHub release stats.")
-    query_github_releases()
+    # The two queries don't depend on each other, so kick off both network
+    # requests up front to overlap their latency.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        releases_future = executor.submit(fetch_github_releases)
+        formula_future = executor.submit(fetch_homebrew_formula)
+
+        print("Querying GitHub release stats.")
+        query_github_releases(*releases_future.result())
 
-    print("Querying Homebrew install stats.")
-    query_homebrew_installs()
+        print("Querying Homebrew install stats.")
+        query_homebrew_installs(formula_future.result())